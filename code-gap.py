@@ -1,97 +1,395 @@
 import os
 import sys
 import argparse
+import asyncio
 import json
 import re
 import ast
+import bisect
+import hashlib
+import tempfile
 from pathlib import Path
-from typing import List, Dict, Tuple, Any, Set
-from collections import defaultdict
+from typing import List, Dict, Tuple, Any, Set, Iterator, Iterable, Optional, TextIO
+from collections import defaultdict, deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate
 
 import tiktoken
 import openai
 
+try:
+    import orjson
+except ImportError:
+    # orjson is optional; the standard library json module is used without it
+    orjson = None
+
 # --- Configuration ---
 # Leave a buffer for the response tokens and prompt overhead
 MAX_TOKENS_PER_REQUEST = 100000  
 MODEL_NAME = "gpt-4-turbo" # This is the model name in Azure, not the deployment name
+# Rust threads tiktoken may use when tokenizing a batch of texts
+TOKENIZER_THREADS = 8
+# Characters tokenized per batch call; bounds the token ids alive at once to a few of these slices
+TOKENIZE_BATCH_CHARS = 4 * 1024 * 1024
+# Threads used to read and parse files; file I/O releases the GIL
+IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# Budget for file contents kept in memory between the scan and chunking passes
+CONTENT_CACHE_BYTES = 200 * 1024 * 1024
+# Rough characters per token; files longer than the limit at this ratio skip counting and are split directly
+CHARS_PER_TOKEN = 4
+# Response budget: a base per chunk for its summary, an allowance per file and a share of the
+# prompt size, capped at the model's output limit. Truncated answers are retried at the cap.
+OUTPUT_TOKENS_PER_CHUNK = 100
+OUTPUT_TOKENS_PER_FILE = 200
+INPUT_TOKENS_PER_OUTPUT_TOKEN = 10
+MAX_OUTPUT_TOKENS = 4096
+# Short keys the model uses for gap fields to save output tokens, expanded after parsing
+GAP_FIELD_KEYS = {"t": "type", "s": "severity", "f": "file", "d": "description", "c": "suggested_change"}
+# Number of chunk requests allowed in flight against Azure OpenAI at once
+MAX_CONCURRENT_REQUESTS = 10
+# Attempts per chunk when Azure OpenAI rate-limits, times out or fails on its side
+MAX_RETRIES = 3
+# Upper bound on a single backoff, including waits asked for by a retry-after header
+MAX_RETRY_DELAY = 60
+# The Batch API requires api-version 2024-07-01-preview or later
+API_VERSION = "2024-10-21"
+# Seconds between status checks while a batch job is running
+BATCH_POLL_INTERVAL = 60
+# Directories never descended into while scanning a repository
+IGNORED_DIRS = {'node_modules', '__pycache__', 'venv', 'env', '.git'}
+# Files with these extensions are known binaries and skipped unread; anything else is read
+# and still dropped if it doesn't decode as UTF-8
+BINARY_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico', '.webp', '.tif', '.tiff', '.psd',
+    '.mp3', '.wav', '.ogg', '.flac', '.mp4', '.mov', '.avi', '.mkv', '.webm',
+    '.zip', '.tar', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.jar', '.war', '.whl', '.egg',
+    '.exe', '.dll', '.so', '.dylib', '.a', '.o', '.obj', '.lib', '.class', '.pyc', '.pyo', '.pyd', '.wasm', '.bin',
+    '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx',
+    '.ttf', '.otf', '.woff', '.woff2', '.eot',
+    '.db', '.sqlite', '.sqlite3', '.pkl', '.pickle', '.npy', '.npz', '.h5', '.parquet',
+    '.onnx', '.pt', '.pth', '.ckpt', '.safetensors', '.iso', '.dmg',
+}
+# Larger files are skipped unread; they are almost always generated or vendored
+MAX_FILE_BYTES = 2 * 1024 * 1024
+# Parsed import sets are cached here across runs, keyed by the SHA-256 of the source
+CACHE_DIR = ".code-gap-cache"
+# Bump whenever the cached data or the way it is extracted changes
+CACHE_VERSION = "3"
+# Blocks searched for imports below module level (ast.TryStar exists on Python 3.11+)
+IMPORT_BLOCK_NODES = (ast.If, ast.Try) + ((ast.TryStar,) if hasattr(ast, "TryStar") else ())
+
+def _json_loads(data: str) -> Any:
+    """Parses JSON with orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _json_dumps(obj: Any) -> str:
+    """Serializes JSON with orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj)
 
 class CodeDocAnalyzer:
     """Analyzes code and documentation to find gaps using Azure OpenAI."""
 
-    def __init__(self, api_key: str, endpoint: str, deployment_name: str):
+    # Static instructions of the analysis prompt, built once; only the files vary per request
+    _PROMPT_TMPL = """
+Analyze the provided code and documentation files to identify gaps between them.
+
+A "gap" is any of the following:
+- **missing_documentation**: Code exists but has no corresponding documentation.
+- **outdated_documentation**: Documentation exists but does not accurately reflect the current code implementation.
+- **missing_implementation**: Documentation describes a feature, function, or API that is not present in the code.
+- **inaccurate_documentation**: Documentation is misleading or incorrect about the code's behavior.
+
+The files are grouped into numbered chunks. Analyze each chunk independently
+and return exactly one entry in "results" per chunk, using the chunk number as its id.
+
+Files to analyze:
+{chunks_text}
+
+Provide your analysis in the following compact JSON format. In each gap, "t" is the type,
+"s" the severity, "f" the file, "d" the description and "c" the suggested change.
+Keep each summary to at most 25 words, "d" to at most 30 words and "c" to at most 25 words.
+{{
+  "results": [
+    {{
+      "id": 0,
+      "summary": "Brief summary of the gap analysis for this chunk.",
+      "gaps": [
+        {{
+          "t": "missing_documentation|outdated_documentation|missing_implementation|inaccurate_documentation",
+          "s": "low|medium|high|critical",
+          "f": "path/to/related/file",
+          "d": "Description of the gap, citing a specific example if possible.",
+          "c": "Actionable suggestion to fix the gap."
+        }}
+      ]
+    }}
+  ]
+}}
+"""
+
+    def __init__(self, api_key: str, endpoint: str, deployment_name: str, cache_dir: str = CACHE_DIR, batch_deployment_name: Optional[str] = None):
         """Initializes the analyzer with Azure OpenAI credentials."""
-        self.client = openai.AzureOpenAI(
+        # The SDK's own retries stay on for the batch and file calls
+        self.client = openai.AsyncAzureOpenAI(
             api_key=api_key,
             azure_endpoint=endpoint,
-            api_version="2024-02-15-preview"
+            api_version=API_VERSION
         )
+        # _create_completion owns the retry policy for chat requests; SDK retries would multiply its attempts
+        self.completions_client = self.client.with_options(max_retries=0)
         self.deployment_name = deployment_name
+        # Azure only accepts Batch API jobs on a Global-Batch deployment, usually distinct from the real-time one
+        self.batch_deployment_name = batch_deployment_name or deployment_name
+        # Keep tiktoken's BPE files in a stable location so they are downloaded once.
+        # In GitHub Actions, persist it between runs with actions/cache, e.g.
+        #   path: ~/.cache/tiktoken
+        #   key: tiktoken-${{ runner.os }}-cl100k_base
+        os.environ.setdefault("TIKTOKEN_CACHE_DIR", str(Path.home() / ".cache" / "tiktoken"))
         # Use tiktoken for accurate token counting, compatible with OpenAI models
         try:
             self.encoding = tiktoken.encoding_for_model(MODEL_NAME)
         except KeyError:
             self.encoding = tiktoken.get_encoding("cl100k_base") # Default for GPT-4
+        # Cache entries are only valid for the Python version whose parser produced them
+        self.ast_cache_dir = Path(cache_dir) / "ast" / f"py{sys.version_info[0]}{sys.version_info[1]}-v{CACHE_VERSION}"
+        self.io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS)
+        # Sizes of the files in the code and docs repositories by relative path, filled by _extract_code_structure;
+        # None marks a known binary or unreadable file, which is indexed so it still shadows the other repository
+        self._code_files: Dict[str, Optional[int]] = {}
+        self._docs_files: Dict[str, Optional[int]] = {}
+        # Files left out of the analysis by _create_chunks without being opened
+        self.skipped_by_extension = 0
+        self.skipped_by_size = 0
+        # Raw bytes read during the scan, reused once by _create_chunks instead of reading the file again
+        self._content_cache: "OrderedDict[str, bytes]" = OrderedDict()
+        self._content_cache_size = 0
+        # Header token counts by path, kept per instance so they go away with it
+        self._header_tokens: Dict[str, int] = {}
 
     def _count_tokens(self, text: str) -> int:
-        """Counts the number of tokens in a text string."""
-        return len(self.encoding.encode(text))
+        """
+        Counts the number of tokens in a text string. Special-token markers are
+        counted as plain text, which skips tiktoken's per-call scan for them and
+        keeps files that happen to contain "<|endoftext|>" from raising.
+        """
+        return len(self.encoding.encode_ordinary(text))
+
+    def _count_header_tokens(self, file_path: str) -> int:
+        """Counts the tokens of the "File: ..." header that introduces a file in a chunk."""
+        tokens = self._header_tokens.get(file_path)
+        if tokens is None:
+            tokens = self._header_tokens[file_path] = self._count_tokens(f"File: {file_path}\n\n")
+        return tokens
+
+    def _encode_batch(self, texts: List[str]) -> List[List[int]]:
+        """Tokenizes many texts in one call, in parallel."""
+        return self.encoding.encode_ordinary_batch(texts, num_threads=TOKENIZER_THREADS)
+
+    def _iter_file_tokens(self, files: List[Tuple[str, str]]) -> Iterator[Tuple[int, Optional[List[int]]]]:
+        """
+        Yields (tokens, ids) for each (path, content) in `files`: the tokens of the
+        body plus its header, and the body's encoding only when the file exceeds
+        the request limit and will be split. Bodies are tokenized in slices of
+        about TOKENIZE_BATCH_CHARS and plain counts are kept for the rest, so
+        memory doesn't grow with the size of the group.
+        """
+        start = 0
+        while start < len(files):
+            end, chars = start, 0
+            while end < len(files) and (end == start or chars + len(files[end][1]) <= TOKENIZE_BATCH_CHARS):
+                chars += len(files[end][1])
+                end += 1
+            encoded = self._encode_batch([content for _, content in files[start:end]])
+            for (file_path, _), ids in zip(files[start:end], encoded):
+                tokens = len(ids) + self._count_header_tokens(file_path)
+                yield tokens, ids if tokens > MAX_TOKENS_PER_REQUEST else None
+            del encoded
+            start = end
+
+    def _count_tokens_batch(self, texts: List[str]) -> List[int]:
+        """Counts tokens for many texts in one call, tokenizing them in parallel."""
+        return [len(ids) for ids in self._encode_batch(texts)]
+
+    def _iter_tree(self, root: str) -> Iterator[Tuple[str, os.DirEntry]]:
+        """
+        Walks the tree under `root` with os.scandir, yielding (relative_dir, entry)
+        pairs for every visible directory and file. DirEntry caches the type
+        information from readdir, so no extra stat calls are made per file.
+        """
+        pending = deque([(root, '.')])
+        while pending:
+            path, rel_dir = pending.popleft()
+            try:
+                with os.scandir(path) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    # Skip irrelevant directories; like os.walk, don't follow directory symlinks
+                    if entry.name in IGNORED_DIRS or entry.is_symlink():
+                        continue
+                    pending.append((entry.path, entry.name if rel_dir == '.' else os.path.join(rel_dir, entry.name)))
+                yield rel_dir, entry
 
-    def _extract_code_structure(self, repo_path: str) -> Dict[str, Any]:
+    def _extract_code_structure(self, repo_path: str, docs_repo_path: Optional[str] = None) -> Dict[str, Any]:
         """
         Extracts the structure of the repository, including directories,
-        files, and Python import relationships.
+        files, and Python import relationships. Also indexes the files of
+        both repositories so later lookups need no filesystem probes.
         """
         structure = {
             "directories": set(),
             "files": {},
             "imports": defaultdict(set),
         }
+        python_rel_paths, python_full_paths = [], []
+        self._code_files = {}
         
-        for root, dirs, files in os.walk(repo_path):
-            # Skip irrelevant directories
-            dirs[:] = [d for d in dirs if not d.startswith('.') and d not in ['node_modules', '__pycache__', 'venv', 'env', '.git']]
+        for rel_dir, entry in self._iter_tree(repo_path):
+            rel_path = entry.name if rel_dir == '.' else os.path.join(rel_dir, entry.name)
+            if entry.is_dir():
+                structure["directories"].add(rel_path)
+                continue
             
-            rel_dir = os.path.relpath(root, repo_path)
-            if rel_dir != '.':
-                structure["directories"].add(rel_dir)
+            file_path = entry.path
+            structure["files"][rel_path] = {
+                "path": file_path,
+                "relative_path": rel_path,
+                "directory": rel_dir if rel_dir != '.' else "root",
+                "extension": os.path.splitext(entry.name)[1],
+            }
+            self._code_files[rel_path] = self._file_size(entry)
             
-            for file in files:
-                if file.startswith('.'):
-                    continue
-                    
-                file_path = os.path.join(root, file)
-                rel_path = os.path.relpath(file_path, repo_path)
-                
-                structure["files"][rel_path] = {
-                    "path": file_path,
-                    "relative_path": rel_path,
-                    "directory": rel_dir if rel_dir != '.' else "root",
-                    "extension": os.path.splitext(file)[1],
-                }
-                
-                # Extract imports for Python files to build a dependency graph
-                if file.endswith('.py'):
-                    try:
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            content = f.read()
-                            tree = ast.parse(content)
-                            for node in ast.walk(tree):
-                                if isinstance(node, ast.Import):
-                                    for alias in node.names:
-                                        structure["imports"][rel_path].add(alias.name)
-                                elif isinstance(node, ast.ImportFrom):
-                                    module = node.module or ""
-                                    for alias in node.names:
-                                        structure["imports"][rel_path].add(f"{module}.{alias.name}")
-                    except Exception as e:
-                        print(f"Warning: Could not parse {rel_path} for imports: {e}")
+            # Extract imports for Python files to build a dependency graph
+            if entry.name.endswith('.py'):
+                python_rel_paths.append(rel_path)
+                python_full_paths.append(file_path)
+        
+        # Read and parse Python files in parallel; the main thread only merges results
+        results = self.io_executor.map(self._read_imports, python_rel_paths, python_full_paths)
+        for rel_path, file_path, (content_bytes, imports) in zip(python_rel_paths, python_full_paths, results):
+            if content_bytes is not None:
+                self._remember_content(file_path, content_bytes)
+            if imports:
+                structure["imports"][rel_path].update(imports)
+        
+        if docs_repo_path:
+            self._docs_files = {}
+            for rel_dir, entry in self._iter_tree(docs_repo_path):
+                if not entry.is_dir():
+                    self._docs_files[entry.name if rel_dir == '.' else os.path.join(rel_dir, entry.name)] = self._file_size(entry)
         
         # Convert sets to lists for JSON serialization
         structure["directories"] = list(structure["directories"])
         structure["imports"] = {k: list(v) for k, v in structure["imports"].items()}
         return structure
 
+    def _file_size(self, entry: os.DirEntry) -> Optional[int]:
+        """Returns the size of a file, or None for known binary or unreadable files."""
+        if self._has_binary_extension(entry.name):
+            return None
+        try:
+            # Cached on the DirEntry, so the size costs at most one stat during the scan
+            return entry.stat().st_size
+        except OSError:
+            return None
+
+    def _has_binary_extension(self, path: str) -> bool:
+        """Whether a path's extension marks it as a binary file."""
+        return os.path.splitext(path)[1].lower() in BINARY_EXTENSIONS
+
+    def _read_imports(self, rel_path: str, file_path: str) -> Tuple[Optional[bytes], Set[str]]:
+        """Reads a Python file and returns its bytes and imports; runs on the I/O thread pool."""
+        content_bytes = None
+        try:
+            with open(file_path, 'rb') as f:
+                content_bytes = f.read()
+            return content_bytes, self._cached_imports(content_bytes)
+        except Exception as e:
+            print(f"Warning: Could not parse {rel_path} for imports: {e}")
+            return content_bytes, set()
+
+    def _remember_content(self, path: str, content_bytes: bytes):
+        """Keeps a file's bytes for the chunking pass, evicting the oldest entries beyond the budget."""
+        if len(content_bytes) > CONTENT_CACHE_BYTES:
+            return
+        self._content_cache[path] = content_bytes
+        self._content_cache_size += len(content_bytes)
+        while self._content_cache_size > CONTENT_CACHE_BYTES:
+            _, evicted = self._content_cache.popitem(last=False)
+            self._content_cache_size -= len(evicted)
+
+    def _take_content(self, path: str) -> Optional[bytes]:
+        """Removes and returns a file's cached bytes, if the scan kept them."""
+        content_bytes = self._content_cache.pop(path, None)
+        if content_bytes is not None:
+            self._content_cache_size -= len(content_bytes)
+        return content_bytes
+
+    def _extract_imports(self, content: str) -> Set[str]:
+        """
+        Returns the modules and names imported by a Python source file.
+        Only module-level statements are scanned, including those nested in
+        if/try blocks such as optional-dependency or TYPE_CHECKING guards.
+        Imports inside functions and classes are deliberately missed: they
+        are rare, and skipping them avoids walking every function body.
+        """
+        imports = set()
+        tree = ast.parse(content)
+        stack = list(tree.body)
+        while stack:
+            node = stack.pop()
+            if isinstance(node, IMPORT_BLOCK_NODES):
+                stack.extend(node.body)
+                stack.extend(node.orelse)
+                for handler in getattr(node, 'handlers', []):
+                    stack.extend(handler.body)
+                stack.extend(getattr(node, 'finalbody', []))
+            elif isinstance(node, ast.Import):
+                for alias in node.names:
+                    imports.add(alias.name)
+            elif isinstance(node, ast.ImportFrom):
+                module = node.module or ""
+                for alias in node.names:
+                    imports.add(f"{module}.{alias.name}")
+        return imports
+
+    def _cached_imports(self, content_bytes: bytes) -> Set[str]:
+        """
+        Returns the imports of a Python source, reusing the on-disk cache when
+        the same source has been parsed before so unchanged files skip ast.parse.
+        Entries are plain JSON lists, never pickles: the cache directory may sit
+        inside the checkout being analyzed, so its contents are untrusted.
+        """
+        cache_path = self.ast_cache_dir / f"{hashlib.sha256(content_bytes).hexdigest()}.json"
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                cached = _json_loads(f.read())
+            if isinstance(cached, list) and all(isinstance(name, str) for name in cached):
+                return set(cached)
+        except Exception:
+            # Missing or unreadable entry, parse the source again
+            pass
+        
+        imports = self._extract_imports(content_bytes.decode('utf-8'))
+        try:
+            self.ast_cache_dir.mkdir(parents=True, exist_ok=True)
+            # Write to a temporary file first so concurrent runs never read a partial entry
+            with tempfile.NamedTemporaryFile('w', dir=self.ast_cache_dir, suffix='.tmp', encoding='utf-8', delete=False) as f:
+                f.write(_json_dumps(sorted(imports)))
+            os.replace(f.name, cache_path)
+        except OSError as e:
+            print(f"Warning: Could not write AST cache entry {cache_path}: {e}")
+        return imports
+
     def _group_files_semantically(self, code_structure: Dict[str, Any]) -> List[List[str]]:
         """
         Groups files based on directory structure and import relationships.
@@ -104,80 +402,106 @@ class CodeDocAnalyzer:
             directory = file_info["directory"]
             file_groups[directory].add(file_path)
         
-        # Merge groups based on import relationships
-        changed = True
-        while changed:
-            changed = False
-            groups_to_merge = []
-            
-            group_keys = list(file_groups.keys())
-            for i, dir1 in enumerate(group_keys):
-                for dir2 in group_keys[i+1:]:
-                    if dir1 not in file_groups or dir2 not in file_groups: # Already merged
-                        continue
-                    
-                    # Check if files in dir1 import files in dir2
-                    for file1 in file_groups[dir1]:
-                        if file1 in code_structure["imports"]:
-                            for import_path in code_structure["imports"][file1]:
-                                # A simple heuristic: if an import path contains the other directory name, merge
-                                if import_path.startswith(dir2.replace('/', '.')) or import_path.startswith(dir2.replace('\\', '.')):
-                                    groups_to_merge.append((dir1, dir2))
-                                    break
-                        if groups_to_merge:
+        # Merge groups based on import relationships using union-find over directories
+        dir_to_root = {directory: directory for directory in file_groups}
+        
+        def find(directory: str) -> str:
+            while dir_to_root[directory] != directory:
+                dir_to_root[directory] = dir_to_root[dir_to_root[directory]] # Path halving
+                directory = dir_to_root[directory]
+            return directory
+        
+        def union(dir1: str, dir2: str):
+            root1, root2 = find(dir1), find(dir2)
+            if root1 != root2:
+                dir_to_root[root2] = root1
+        
+        # Map each directory's dotted form, computed once, back to the directory so
+        # an import can be resolved by probing its own prefixes, longest first
+        dir_dotted = {directory: directory.replace('/', '.').replace('\\', '.') for directory in file_groups}
+        dir_prefixes = {dotted: directory for directory, dotted in dir_dotted.items()}
+        
+        for dir1, files in file_groups.items():
+            for file1 in files:
+                for import_path in code_structure["imports"].get(file1, []):
+                    # A simple heuristic: if an import path starts with another directory name, merge
+                    for end in range(len(import_path), 0, -1):
+                        dir2 = dir_prefixes.get(import_path[:end])
+                        if dir2 is not None:
+                            union(dir1, dir2)
                             break
-                    if groups_to_merge:
-                        break
-            
-            # Perform the merges
-            for dir1, dir2 in groups_to_merge:
-                if dir1 in file_groups and dir2 in file_groups:
-                    file_groups[dir1].update(file_groups[dir2])
-                    del file_groups[dir2]
-                    changed = True
+        
+        merged_groups = defaultdict(set)
+        for directory, files in file_groups.items():
+            merged_groups[find(directory)].update(files)
+        file_groups = merged_groups
         
         return [list(files) for files in file_groups.values()]
 
     def _create_chunks(self, file_paths: List[str], code_repo_path: str, docs_repo_path: str) -> List[Dict[str, Any]]:
         """
         Creates chunks of files that fit within the token limit.
-        Handles large files by splitting them intelligently.
+        Handles large files by splitting them intelligently. Files are
+        located through the indexes built by _extract_code_structure, and
+        known binary or oversized files are counted and skipped unread.
         """
         chunks = []
         current_chunk_files = []
         current_chunk_tokens = 0
         
+        # Read every file first so all token counts can be computed in one batch
+        resolved = []
         for file_path in file_paths:
             # Determine which repo the file belongs to
             code_full_path = os.path.join(code_repo_path, file_path)
             docs_full_path = os.path.join(docs_repo_path, file_path)
             
-            file_type, full_path = None, None
-            if os.path.exists(code_full_path):
-                file_type, full_path = "code", code_full_path
-            elif os.path.exists(docs_full_path):
-                file_type, full_path = "doc", docs_full_path
+            file_type, full_path, size = None, None, None
+            if file_path in self._code_files:
+                file_type, full_path, size = "code", code_full_path, self._code_files[file_path]
+            elif file_path in self._docs_files:
+                file_type, full_path, size = "doc", docs_full_path, self._docs_files[file_path]
             
-            if not full_path:
+            # Binary and oversized files are skipped before opening them
+            if size is None:
+                if full_path and self._has_binary_extension(file_path):
+                    self.skipped_by_extension += 1
                 continue
-
-            try:
-                with open(full_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-            except UnicodeDecodeError:
-                # Skip binary files
+            if size > MAX_FILE_BYTES:
+                self.skipped_by_size += 1
                 continue
             
-            file_tokens = self._count_tokens(f"File: {file_path}\n\n{content}")
-
+            resolved.append((file_path, file_type, full_path))
+        
+        # Read the files in parallel, reusing bytes kept from the scan where possible
+        files = []
+        full_paths = [full_path for _, _, full_path in resolved]
+        cached = [self._take_content(full_path) for full_path in full_paths]
+        for (file_path, file_type, _), content in zip(resolved, self.io_executor.map(self._read_text, full_paths, cached)):
+            if content is not None:
+                files.append((file_path, file_type, content))
+        
+        # Files this long are split anyway, so only tokenize the rest; each body is
+        # tokenized once and the short header is counted separately and memoized.
+        # The ids are handed to the line splitter for files that still don't fit.
+        large_file_chars = MAX_TOKENS_PER_REQUEST * CHARS_PER_TOKEN
+        file_tokens_iter = self._iter_file_tokens(
+            [(file_path, content) for file_path, _, content in files if len(content) <= large_file_chars])
+        
+        for file_path, file_type, content in files:
+            is_large = len(content) > large_file_chars
+            ids = None
+            if not is_large:
+                file_tokens, ids = next(file_tokens_iter)
+            
             # If the file itself is too large, split it
-            if file_tokens > MAX_TOKENS_PER_REQUEST:
+            if is_large or file_tokens > MAX_TOKENS_PER_REQUEST:
                 # Save current chunk if it has content
                 if current_chunk_files:
                     chunks.append({"files": current_chunk_files, "tokens": current_chunk_tokens})
                     current_chunk_files, current_chunk_tokens = [], 0
                 
-                self._split_large_file(file_path, content, file_type, chunks)
+                self._split_large_file(file_path, content, file_type, chunks, ids)
                 continue
 
             # If adding this file exceeds the limit, start a new chunk
@@ -195,8 +519,28 @@ class CodeDocAnalyzer:
             
         return chunks
 
-    def _split_large_file(self, file_path: str, content: str, file_type: str, chunks: List[Dict[str, Any]]):
-        """Splits a single large file into smaller, manageable chunks."""
+    def _read_text(self, full_path: str, content_bytes: Optional[bytes] = None) -> Optional[str]:
+        """
+        Decodes a text file, reading it unless its bytes are already given.
+        Returns None for binary files; runs on the I/O thread pool.
+        """
+        if content_bytes is None:
+            with open(full_path, 'rb') as f:
+                content_bytes = f.read()
+        try:
+            content = content_bytes.decode('utf-8')
+        except UnicodeDecodeError:
+            # Skip binary files
+            return None
+        # Normalize newlines the same way text-mode open() does
+        return content.replace('\r\n', '\n').replace('\r', '\n')
+
+    def _split_large_file(self, file_path: str, content: str, file_type: str, chunks: List[Dict[str, Any]],
+                          ids: Optional[List[int]] = None):
+        """
+        Splits a single large file into smaller, manageable chunks. `ids` is the
+        content's encoding when the caller already has it.
+        """
         if file_type == "code" and file_path.endswith('.py'):
             try:
                 tree = ast.parse(content)
@@ -213,9 +557,11 @@ class CodeDocAnalyzer:
                 all_items = sorted(functions + classes, key=lambda x: x[0])
                 lines = content.split('\n')
                 
-                for start, end, name in all_items:
-                    chunk_content = '\n'.join(lines[start-1:end])
-                    chunk_tokens = self._count_tokens(f"File: {file_path} ({name})\n\n{chunk_content}")
+                items = [(name, '\n'.join(lines[start-1:end])) for start, end, name in all_items]
+                body_token_counts = self._count_tokens_batch([chunk_content for _, chunk_content in items])
+                
+                for (name, chunk_content), body_tokens in zip(items, body_token_counts):
+                    chunk_tokens = body_tokens + self._count_header_tokens(f"{file_path} ({name})")
                     if chunk_tokens > MAX_TOKENS_PER_REQUEST:
                         # If a single function is too large, split it by lines
                         self._split_by_lines(file_path, chunk_content, file_type, chunks, name)
@@ -230,120 +576,348 @@ class CodeDocAnalyzer:
                 pass
         
         # Fallback for non-Python files or if AST fails
-        self._split_by_lines(file_path, content, file_type, chunks)
+        self._split_by_lines(file_path, content, file_type, chunks, ids=ids)
+
+    def _split_by_lines(self, file_path: str, content: str, file_type: str, chunks: List[Dict[str, Any]], name_suffix="",
+                        ids: Optional[List[int]] = None):
+        """
+        Splits file content on line boundaries to fit token limit. The content is
+        tokenized once; per-line token offsets are prefix sums over that encoding,
+        so each split point is found by bisection instead of re-tokenizing lines.
+        An encoding the caller already made is reused as is.
+        """
+        if ids is None:
+            ids = self.encoding.encode_ordinary(content)
+        data = content.encode('utf-8')
+        
+        # Byte offsets where each token ends and where each line starts
+        token_ends = list(accumulate(len(token) for token in self.encoding.decode_tokens_bytes(ids)))
+        line_starts = [0] + [match.end() for match in re.finditer(b'\n', data)]
+        # Tokens preceding each line start; the extra entry closes the last line
+        line_offsets = [bisect.bisect_right(token_ends, start) for start in line_starts] + [len(ids)]
+        line_bounds = line_starts + [len(data)]
+        num_lines = len(line_starts)
+        path_suffix = f" ({name_suffix})" if name_suffix else ""
+        
+        i = 0
+        while i < num_lines:
+            # Furthest line boundary j such that lines i..j-1 fit in one chunk
+            j = bisect.bisect_right(line_offsets, line_offsets[i] + MAX_TOKENS_PER_REQUEST, i + 1, num_lines + 1) - 1
+            
+            if j == i:
+                # Single line is too long, truncate it
+                start = line_offsets[i]
+                chunks.append({
+                    "files": [{"path": f"{file_path} (truncated)", "content": self.encoding.decode(ids[start:start + MAX_TOKENS_PER_REQUEST]), "type": file_type}],
+                    "tokens": MAX_TOKENS_PER_REQUEST
+                })
+                i += 1
+                continue
+            
+            chunk_content = data[line_bounds[i]:line_bounds[j]].decode('utf-8')
+            if j < num_lines:
+                # Drop the newline that terminates the chunk's last line
+                chunk_content = chunk_content[:-1]
+            if chunk_content:
+                chunks.append({
+                    "files": [{"path": f"{file_path}{path_suffix}", "content": chunk_content, "type": file_type}],
+                    "tokens": line_offsets[j] - line_offsets[i]
+                })
+            i = j
 
-    def _split_by_lines(self, file_path: str, content: str, file_type: str, chunks: List[Dict[str, Any]], name_suffix=""):
-        """Splits file content by line count to fit token limit."""
-        lines = content.split('\n')
-        current_lines = []
-        current_tokens = 0
+    def _pack_chunks(self, chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Packs consecutive chunks into shared requests while the combined prompt
+        stays within the token limit, so small chunks don't each pay for the
+        instructions. A packed request keeps the chunk shape ("files", "tokens")
+        and lists its members under "chunks".
+        """
+        prompt_tokens = self._count_tokens(self._create_analysis_prompt([]))
+        # The heading with the largest possible id bounds the cost of every heading
+        header_tokens = self._count_tokens(self._format_chunk_header(len(chunks)))
+        requests = []
+        current = None
         
-        for line in lines:
-            line_tokens = self._count_tokens(line + '\n')
+        for chunk in chunks:
+            chunk_tokens = chunk["tokens"] + header_tokens
+            if (current is None
+                    or current["tokens"] + chunk_tokens > MAX_TOKENS_PER_REQUEST
+                    or self._max_output_tokens(len(current["chunks"]) + 1, len(current["files"]) + len(chunk["files"]),
+                                               current["tokens"] + chunk_tokens) >= MAX_OUTPUT_TOKENS):
+                current = {"chunks": [], "files": [], "tokens": prompt_tokens}
+                requests.append(current)
             
-            if current_tokens + line_tokens > MAX_TOKENS_PER_REQUEST:
-                if current_lines:
-                    chunk_content = '\n'.join(current_lines)
-                    path_suffix = f" ({name_suffix})" if name_suffix else ""
-                    chunks.append({
-                        "files": [{"path": f"{file_path}{path_suffix}", "content": chunk_content, "type": file_type}],
-                        "tokens": current_tokens
-                    })
-                    current_lines, current_tokens = [line], line_tokens
-                else:
-                    # Single line is too long, truncate it
-                    truncated_line = line[:MAX_TOKENS_PER_REQUEST // 4]
-                    chunks.append({
-                        "files": [{"path": f"{file_path} (truncated)", "content": truncated_line, "type": file_type}],
-                        "tokens": self._count_tokens(truncated_line)
-                    })
-            else:
-                current_lines.append(line)
-                current_tokens += line_tokens
-        
-        # Add remaining lines
-        if current_lines:
-            chunk_content = '\n'.join(current_lines)
-            path_suffix = f" ({name_suffix})" if name_suffix else ""
-            chunks.append({
-                "files": [{"path": f"{file_path}{path_suffix}", "content": chunk_content, "type": file_type}],
-                "tokens": current_tokens
-            })
-
-    def _analyze_chunk(self, chunk: Dict[str, Any]) -> Dict[str, Any]:
+            current["chunks"].append(chunk)
+            current["files"].extend(chunk["files"])
+            current["tokens"] += chunk_tokens
+        
+        return requests
+
+    def _max_output_tokens(self, num_chunks: int, num_files: int, input_tokens: int) -> int:
+        """Estimates the response size needed for a request, capped at the model's output limit."""
+        return min(MAX_OUTPUT_TOKENS, num_chunks * OUTPUT_TOKENS_PER_CHUNK + num_files * OUTPUT_TOKENS_PER_FILE
+                   + input_tokens // INPUT_TOKENS_PER_OUTPUT_TOKEN)
+
+    def _build_request_body(self, chunk: Dict[str, Any]) -> Dict[str, Any]:
+        """Builds the chat completion request for a packed chunk, shared by the real-time and batch paths."""
+        return {
+            "model": self.deployment_name, # Deployment name in Azure
+            "messages": [
+                {"role": "system", "content": "You are an expert software architect and documentation specialist."},
+                {"role": "user", "content": self._create_analysis_prompt(chunk["chunks"])}
+            ],
+            "temperature": 0.2, # Lower temperature for more deterministic output
+            "max_tokens": self._max_output_tokens(len(chunk["chunks"]), len(chunk["files"]), chunk["tokens"]),
+            "response_format": {"type": "json_object"} # Enforce JSON output
+        }
+
+    def _parse_result(self, result_text: str, chunk: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Parses the model's JSON answer for a packed chunk, expands the short gap
+        keys and tags each entry in "results" with the files of the chunk it
+        answers for.
+        """
+        result = _json_loads(result_text)
+        for chunk_result in result.get("results", []):
+            if not isinstance(chunk_result, dict):
+                continue
+            # A malformed "gaps" value only empties this entry, not the whole request
+            gaps = chunk_result.get("gaps")
+            chunk_result["gaps"] = [
+                {GAP_FIELD_KEYS.get(key, key): value for key, value in gap.items()}
+                for gap in (gaps if isinstance(gaps, list) else []) if isinstance(gap, dict)
+            ]
+            member_id = chunk_result.get("id")
+            if isinstance(member_id, bool):
+                continue
+            try:
+                member_id = int(member_id)
+            except (TypeError, ValueError, OverflowError):
+                continue
+            # Negative ids would otherwise index from the end
+            if not 0 <= member_id < len(chunk["chunks"]):
+                continue
+            chunk_result["files_analyzed"] = [f["path"] for f in chunk["chunks"][member_id]["files"]]
+        return result
+
+    async def _create_completion(self, request_body: Dict[str, Any]) -> Any:
+        """
+        Sends one chat completion request, backing off when rate-limited, timed
+        out, disconnected or answered with a server error.
+        """
+        for attempt in range(MAX_RETRIES):
+            try:
+                return await self.completions_client.chat.completions.create(**request_body)
+            except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                delay = self._retry_delay(e, attempt)
+                print(f"   Retrying chunk in {delay:g}s after: {e}")
+                await asyncio.sleep(delay)
+
+    def _retry_delay(self, error: Exception, attempt: int) -> float:
+        """
+        Seconds to wait before retrying after `error`: the server's retry-after
+        header when it sends one (Azure does on 429s), else exponential backoff.
+        """
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            # Missing or an HTTP date; exponential backoff: 1s, 2s, 4s, ...
+            delay = 2 ** attempt
+        return min(max(delay, 0), MAX_RETRY_DELAY)
+
+    async def _analyze_chunk(self, chunk: Dict[str, Any]) -> Dict[str, Any]:
         """Sends a chunk of files to Azure OpenAI for gap analysis."""
-        prompt = self._create_analysis_prompt(chunk["files"])
+        request_body = self._build_request_body(chunk)
         
         try:
-            response = self.client.chat.completions.create(
-                model=self.deployment_name, # Deployment name in Azure
-                messages=[
-                    {"role": "system", "content": "You are an expert software architect and documentation specialist."},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.2, # Lower temperature for more deterministic output
-                response_format={"type": "json_object"} # Enforce JSON output
-            )
+            response = await self._create_completion(request_body)
+            if response.choices[0].finish_reason == "length" and request_body["max_tokens"] < MAX_OUTPUT_TOKENS:
+                # The estimate was too small and the JSON got cut off; ask again at the cap
+                print(f"   Response truncated at {request_body['max_tokens']} tokens, retrying chunk with {MAX_OUTPUT_TOKENS}")
+                request_body["max_tokens"] = MAX_OUTPUT_TOKENS
+                response = await self._create_completion(request_body)
             
-            result_text = response.choices[0].message.content
-            return json.loads(result_text)
+            choice = response.choices[0]
+            if choice.finish_reason == "length":
+                raise RuntimeError(f"Response truncated at {request_body['max_tokens']} output tokens")
+            return self._parse_result(choice.message.content, chunk)
             
         except Exception as e:
             print(f"Error analyzing chunk: {e}")
-            return {
-                "error": str(e),
-                "files_analyzed": [f["path"] for f in chunk["files"]],
-                "structured": False
-            }
+            return self._error_result(chunk, e)
+
+    def _error_result(self, chunk: Dict[str, Any], error: BaseException) -> Dict[str, Any]:
+        """Builds the placeholder result recorded for a chunk that could not be analyzed."""
+        return {
+            "error": str(error),
+            "files_analyzed": [f["path"] for f in chunk["files"]],
+            "structured": False
+        }
+
+    def _write_result(self, results_file: TextIO, result: Dict[str, Any]):
+        """Appends one request's result to the results file as a JSON line."""
+        results_file.write(_json_dumps(result) + "\n")
+        # Flush so finished work survives a crash later in the run
+        results_file.flush()
+
+    def _read_results(self, results_path: str) -> Iterator[Dict[str, Any]]:
+        """Yields the results written by _write_result, one line at a time."""
+        with open(results_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield _json_loads(line)
 
-    def _create_analysis_prompt(self, files: List[Dict[str, Any]]) -> str:
-        """Creates the detailed prompt for the LLM."""
-        files_text = ""
-        for file_info in files:
-            files_text += f"File: {file_info['path']} ({file_info['type']})\n"
-            files_text += "```\n"
-            files_text += file_info['content']
-            files_text += "\n```\n\n"
+    async def _analyze_chunks(self, chunks: List[Dict[str, Any]], results_file: TextIO, max_concurrency: int = MAX_CONCURRENT_REQUESTS):
+        """
+        Analyzes all chunks concurrently, keeping at most `max_concurrency` requests
+        in flight, and streams each result to `results_file` as soon as it arrives.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
         
-        prompt = f"""
-Analyze the provided code and documentation files to identify gaps between them.
+        async def bounded(i: int, chunk: Dict[str, Any]):
+            async with semaphore:
+                print(f"   Analyzing request {i+1}/{len(chunks)} ({len(chunk['chunks'])} chunks, {len(chunk['files'])} files, {chunk['tokens']} tokens)...")
+                try:
+                    result = await self._analyze_chunk(chunk)
+                except Exception as e:
+                    result = self._error_result(chunk, e)
+            # Writes happen on the event loop thread, so lines never interleave
+            self._write_result(results_file, result)
+        
+        await asyncio.gather(*(bounded(i, chunk) for i, chunk in enumerate(chunks)))
 
-A "gap" is any of the following:
-- **missing_documentation**: Code exists but has no corresponding documentation.
-- **outdated_documentation**: Documentation exists but does not accurately reflect the current code implementation.
-- **missing_implementation**: Documentation describes a feature, function, or API that is not present in the code.
-- **inaccurate_documentation**: Documentation is misleading or incorrect about the code's behavior.
+    def _build_batch_jsonl(self, chunks: List[Dict[str, Any]]) -> str:
+        """Writes one Batch API request per chunk to a temporary JSONL file and returns its path."""
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', encoding='utf-8', delete=False) as f:
+            for i, chunk in enumerate(chunks):
+                body = self._build_request_body(chunk)
+                body["model"] = self.batch_deployment_name
+                f.write(_json_dumps({
+                    "custom_id": f"chunk-{i}",
+                    "method": "POST",
+                    "url": "/chat/completions",
+                    "body": body
+                }) + "\n")
+            return f.name
 
-Files to analyze:
-{files_text}
+    async def _analyze_chunks_batch(self, chunks: List[Dict[str, Any]], results_file: TextIO):
+        """
+        Analyzes all chunks through the Azure OpenAI Batch API and streams each
+        result to `results_file`. Requests are billed at the batch rate and
+        scheduled by Azure within a 24h window. Raises RuntimeError when the
+        batch ends without returning any results.
+        """
+        jsonl_path = self._build_batch_jsonl(chunks)
+        try:
+            with open(jsonl_path, 'rb') as f:
+                batch_file = await self.client.files.create(file=f, purpose="batch")
+        finally:
+            os.remove(jsonl_path)
+        
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/chat/completions",
+            completion_window="24h"
+        )
+        print(f"   Submitted batch {batch.id} with {len(chunks)} requests.")
+        
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            try:
+                batch = await self.client.batches.retrieve(batch.id)
+            except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                # The job keeps running on Azure's side; check again at the next poll
+                print(f"   Could not check batch {batch.id}, will retry: {e}")
+                continue
+            counts = batch.request_counts
+            progress = f" ({counts.completed}/{counts.total} requests)" if counts else ""
+            print(f"   Batch {batch.id} is {batch.status}{progress}...")
+        
+        if batch.errors and batch.errors.data:
+            for error in batch.errors.data:
+                line = f" (line {error.line})" if error.line is not None else ""
+                print(f"Error in batch {batch.id}{line}: {error.code}: {error.message}")
+        
+        # Expired or cancelled batches can still carry results for the requests that finished
+        answered = set()
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await self.client.files.content(file_id)
+            for line in content.text.splitlines():
+                if not line.strip():
+                    continue
+                # A line that can't be tied to a request is skipped; its request is reported as unanswered below
+                try:
+                    record = _json_loads(line)
+                    index = int(record["custom_id"].rsplit("-", 1)[1])
+                except Exception as e:
+                    print(f"Warning: Skipping unreadable line in batch {batch.id} output: {e}")
+                    continue
+                if not 0 <= index < len(chunks):
+                    print(f"Warning: Skipping result for unknown request {record['custom_id']} in batch {batch.id}")
+                    continue
+                response = record.get("response") or {}
+                try:
+                    if record.get("error") or response.get("status_code") != 200:
+                        raise RuntimeError(record.get("error") or response.get("body"))
+                    choice = response["body"]["choices"][0]
+                    # A batch can't be retried per request, so a cut-off answer is reported as such
+                    if choice.get("finish_reason") == "length":
+                        chunk = chunks[index]
+                        max_tokens = self._max_output_tokens(len(chunk["chunks"]), len(chunk["files"]), chunk["tokens"])
+                        raise RuntimeError(f"Response truncated at {max_tokens} output tokens")
+                    result = self._parse_result(choice["message"]["content"], chunks[index])
+                except Exception as e:
+                    print(f"Error analyzing chunk: {e}")
+                    result = self._error_result(chunks[index], e)
+                self._write_result(results_file, result)
+                answered.add(index)
+        
+        if batch.status != "completed" and not answered:
+            raise RuntimeError(f"Batch {batch.id} ended as {batch.status} without returning any results.")
+        
+        for i, chunk in enumerate(chunks):
+            if i not in answered:
+                self._write_result(results_file, self._error_result(chunk, RuntimeError(f"No result returned, batch {batch.status}")))
 
-Provide your analysis in the following JSON format:
-{{
-  "summary": "Brief summary of the overall gap analysis for this chunk.",
-  "gaps": [
-    {{
-      "type": "missing_documentation|outdated_documentation|missing_implementation|inaccurate_documentation",
-      "severity": "low|medium|high|critical",
-      "file": "path/to/related/file",
-      "description": "Detailed description of the gap, citing specific examples if possible.",
-      "suggested_change": "A clear, actionable suggestion to fix the gap."
-    }}
-  ]
-}}
-"""
-        return prompt
+    def _format_chunk_header(self, chunk_id: int) -> str:
+        """Heading that introduces one chunk inside a packed prompt."""
+        return f"### Chunk {chunk_id}\n\n"
+
+    def _create_analysis_prompt(self, chunks: List[Dict[str, Any]]) -> str:
+        """Creates the detailed prompt for the LLM covering one or more chunks."""
+        parts = []
+        for chunk_id, chunk in enumerate(chunks):
+            parts.append(self._format_chunk_header(chunk_id))
+            for file_info in chunk["files"]:
+                parts.append(f"File: {file_info['path']} ({file_info['type']})\n```\n{file_info['content']}\n```\n\n")
+        return self._PROMPT_TMPL.format(chunks_text="".join(parts))
 
-    def synthesize_results(self, chunk_results: List[Dict[str, Any]]) -> Dict[str, Any]:
-        """Combines results from all chunks into a final report."""
+    def synthesize_results(self, chunk_results: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Combines results from all chunks into a final report. `chunk_results` is
+        consumed once, so it can be streamed from the results file.
+        """
         all_gaps = []
         files_analyzed = set()
+        failed_requests = 0
         
         for result in chunk_results:
-            if "error" in result or "gaps" not in result:
+            if "error" in result or "results" not in result:
+                failed_requests += 1
                 continue
-                
-            files_analyzed.update(result.get("files_analyzed", []))
-            all_gaps.extend(result["gaps"])
+            
+            # Each request answers for several packed chunks; split them back out
+            for chunk_result in result["results"]:
+                if not isinstance(chunk_result, dict) or "gaps" not in chunk_result:
+                    continue
+                files_analyzed.update(chunk_result.get("files_analyzed", []))
+                all_gaps.extend(chunk_result["gaps"])
         
         # Sort gaps by severity
         severity_order = {"critical": 0, "high": 1, "medium": 2, "low": 3}
@@ -354,11 +928,14 @@ Provide your analysis in the following JSON format:
         
         summary = f"Analyzed {len(files_analyzed)} files and found {len(all_gaps)} gaps. "
         summary += f"Priority: {critical_count} critical and {high_count} high-severity issues require immediate attention."
+        if failed_requests:
+            summary += f" {failed_requests} requests failed, so their files were not analyzed."
         
         return {
             "summary": summary,
             "gaps": all_gaps,
-            "files_analyzed": sorted(list(files_analyzed))
+            "files_analyzed": sorted(list(files_analyzed)),
+            "failed_requests": failed_requests
         }
 
     def generate_markdown_report(self, results: Dict[str, Any]) -> str:
@@ -383,6 +960,8 @@ Provide your analysis in the following JSON format:
                         report += f"**Description:** {gap.get('description', 'No description')}\n\n"
                         report += f"**Suggested Change:** {gap.get('suggested_change', 'No suggestion')}\n\n"
                         report += "---\n\n"
+        elif results.get('failed_requests'):
+            report += "## ⚠️ Incomplete Analysis\n\nNo gaps were found in the files that were analyzed, but some requests failed. See the summary above.\n\n"
         else:
             report += "## ✅ No Gaps Found\n\nCongratulations! The analysis did not find any significant gaps between the code and documentation.\n\n"
         
@@ -393,6 +972,9 @@ def main():
     parser.add_argument('--code-repo', required=True, help='Path to the code repository.')
     parser.add_argument('--docs-repo', required=True, help='Path to the documentation repository.')
     parser.add_argument('--output-file', default='gap_analysis_report.md', help='Output file name for the report.')
+    parser.add_argument('--max-concurrency', type=int, default=MAX_CONCURRENT_REQUESTS, help='Maximum number of concurrent Azure OpenAI requests.')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='Directory for the persistent parse cache.')
+    parser.add_argument('--batch', action='store_true', help='Submit all chunks as one Azure OpenAI Batch API job instead of real-time requests. Uses AZURE_OPENAI_BATCH_DEPLOYMENT_NAME if set.')
     
     args = parser.parse_args()
     
@@ -400,16 +982,18 @@ def main():
     api_key = os.environ.get('AZURE_OPENAI_API_KEY')
     endpoint = os.environ.get('AZURE_OPENAI_ENDPOINT')
     deployment_name = os.environ.get('AZURE_OPENAI_DEPLOYMENT_NAME')
+    # Optional Global-Batch deployment for --batch; falls back to the real-time deployment
+    batch_deployment_name = os.environ.get('AZURE_OPENAI_BATCH_DEPLOYMENT_NAME')
     
     if not all([api_key, endpoint, deployment_name]):
         print("Error: AZURE_OPENAI_API_KEY, AZURE_OPENAI_ENDPOINT, and AZURE_OPENAI_DEPLOYMENT_NAME must be set as environment variables.")
         sys.exit(1)
         
     print("Initializing Azure OpenAI Analyzer...")
-    analyzer = CodeDocAnalyzer(api_key, endpoint, deployment_name)
+    analyzer = CodeDocAnalyzer(api_key, endpoint, deployment_name, args.cache_dir, batch_deployment_name)
     
     print("1. Extracting code structure...")
-    code_structure = analyzer._extract_code_structure(args.code_repo)
+    code_structure = analyzer._extract_code_structure(args.code_repo, args.docs_repo)
     
     print("2. Grouping files semantically...")
     file_groups = analyzer._group_files_semantically(code_structure)
@@ -421,16 +1005,27 @@ def main():
         chunks = analyzer._create_chunks(group, args.code_repo, args.docs_repo)
         all_chunks.extend(chunks)
     print(f"   Created {len(all_chunks)} chunks total.")
+    if analyzer.skipped_by_extension or analyzer.skipped_by_size:
+        print(f"   Skipped {analyzer.skipped_by_extension} binary files by extension and {analyzer.skipped_by_size} files over {MAX_FILE_BYTES // (1024 * 1024)} MB.")
+    requests = analyzer._pack_chunks(all_chunks)
+    print(f"   Packed into {len(requests)} requests.")
     
     print("4. Analyzing chunks with Azure OpenAI...")
-    chunk_results = []
-    for i, chunk in enumerate(all_chunks):
-        print(f"   Analyzing chunk {i+1}/{len(all_chunks)} ({len(chunk['files'])} files, {chunk['tokens']} tokens)...")
-        result = analyzer._analyze_chunk(chunk)
-        chunk_results.append(result)
+    # Stream results to disk as they arrive to bound memory and keep finished work on a crash
+    results_path = f"{os.path.splitext(args.output_file)[0]}.partial.jsonl"
+    with open(results_path, 'w', encoding='utf-8') as results_file:
+        if args.batch:
+            try:
+                asyncio.run(analyzer._analyze_chunks_batch(requests, results_file))
+            except (RuntimeError, openai.APIError) as e:
+                print(f"Error: {e}")
+                sys.exit(1)
+        else:
+            asyncio.run(analyzer._analyze_chunks(requests, results_file, args.max_concurrency))
+    print(f"   Raw results saved to {results_path}")
     
     print("5. Synthesizing results...")
-    final_results = analyzer.synthesize_results(chunk_results)
+    final_results = analyzer.synthesize_results(analyzer._read_results(results_path))
     
     print("6. Generating Markdown report...")
     report = analyzer.generate_markdown_report(final_results)